@@ -13,10 +13,17 @@ from heapq import *
 import threading
 import time
 
+from flight_recorder import FlightRecorder, SamplingProfiler, install_signal_handlers
+
 # Please do not modify the name of the log file, otherwise you will lose points because the grader won't be able to find your log file
 LOG_FILE = "Controller.log"
+# The number of recent control events kept by the flight recorder. Dumped to Controller.flight.log on SIGUSR1.
+FLIGHT_RECORDER_SIZE = 10000
 K = 2
 TIMEOUT = 3 * K
+# When routing on latency, a link's length only follows its measured latency once it would change by more than this fraction,
+# so that small fluctuations do not trigger recomputes
+LATENCY_HYSTERESIS = 0.2
 
 # Those are logging functions to help you follow the correct logging standard
 
@@ -116,8 +123,21 @@ def write_to_log(log):
 
 class Controller:
 
-    def __init__(self, port, config_file):
+    def __init__(self, port, config_file, sock=None, latency_weight=0):
+        """
+        Controller constructor. A socket-like object may be passed in as sock (e.g. by the emulator),
+        otherwise a UDP socket bound to the given port is created.
+        latency_weight is how much each millisecond of round trip time measured by the switches adds to the length
+        of a link. 0 routes on the lengths from the config file only.
+        """
         self.port = port
+        self.latency_weight = latency_weight
+        # The smoothed round trip time in seconds last reported by a switch for the link to a neighbor
+        self.link_rtts = {}
+        # The clock used for TIMEOUT bookkeeping. The emulator swaps this for a virtual clock.
+        self.clock = time.time
+        # Recent control events, kept in case convergence needs to be investigated
+        self.recorder = FlightRecorder(FLIGHT_RECORDER_SIZE)
 
         # Read in the configuration file
         file = open(config_file, "r")
@@ -135,8 +155,14 @@ class Controller:
         self.switch_statuses = [False] * self.total_switches
 
         # Create a socket
-        self.sock = socket(AF_INET, SOCK_DGRAM)
-        self.sock.bind(("localhost", port))
+        if sock is None:
+            sock = socket(AF_INET, SOCK_DGRAM)
+            sock.bind(("localhost", port))
+        self.sock = sock
+        # Set once the bootstrap process has sent out the register responses
+        self.bootstrapped = False
+        # Held while changing the lengths and recomputing and sending out the routes, since the timeout threads do that too
+        self.lock = threading.Lock()
 
         # Determine the lengths and initially the neighbors of the switches from the config file
         # This assumes that all of the links and switches start in a working state
@@ -156,6 +182,21 @@ class Controller:
             self.neighbors[node1].append(node2)
             self.neighbors[node2].append(node1)
 
+        # Shortest path trees from each switch, kept between calls to compute_routes so that only
+        # the trees affected by a change in the link lengths need to be recomputed
+        self.tree_dists = [None] * self.total_switches
+        self.tree_parents = [None] * self.total_switches
+        self.tree_first_hops = [None] * self.total_switches
+        self.tree_routes = [None] * self.total_switches
+        # The route update message built from each tree, None when it needs to be rebuilt
+        self.route_messages = [None] * self.total_switches
+        # The link lengths the trees above were computed with
+        self.routed_lengths = {}
+        # The version of the routing table and the routes going out from each switch, read by route queries
+        self.route_snapshot = (0, [[] for i in range(self.total_switches)])
+        # Paths memoized by (src, dst) for the table version they were built from
+        self.path_cache = (0, {})
+
     def bootstrap(self):
         """
         Run the bootstrap code.
@@ -165,35 +206,45 @@ class Controller:
         while self.num_online_switches < self.total_switches:
             # Note: Must not use await_register_request() since only send register responses once all requests happen
             data, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
-            data = data.decode("utf-8")
-            switch_id = int(data[0])
-            # Log that we received the register request
-            register_request_received(switch_id)
-            # Consider switch to be alive
-            self.switch_statuses[switch_id] = True
-            print("Received Register Request: %s" % data)
-            print(addr)
-            print(switch_id)
-            self.switch_hostnames[switch_id] = addr[0]
-            self.switch_ports[switch_id] = addr[1]
-            self.num_online_switches += 1
+            self.handle_bootstrap_request(data.decode("utf-8"), addr)
+        self.finish_bootstrap()
 
+    def handle_bootstrap_request(self, data, addr):
+        """
+        Record a register request received while waiting for all switches to come online.
+        """
+        switch_id = int(data.split(" ")[0])
+        self.recorder.record("recv", "register_request", switch_id, len(data))
+        # Log that we received the register request
+        register_request_received(switch_id)
+        # Consider switch to be alive
+        self.switch_statuses[switch_id] = True
+        print("Received Register Request: %s" % data)
+        print(addr)
+        print(switch_id)
+        self.switch_hostnames[switch_id] = addr[0]
+        self.switch_ports[switch_id] = addr[1]
+        self.num_online_switches += 1
+
+    def finish_bootstrap(self):
+        """
+        Once all switches have registered, compute the routes and send out the register responses and route updates.
+        """
         # Compute the routing table
         self.compute_routes()
         # Send the register responses and start threads to keep track of TIMEOUT
         for switch_id in range(self.num_online_switches):
             self.send_register_response(switch_id)
             # Set the last update time to now
-            self.last_update_times[switch_id] = time.time()
-            # Create a new thread
-            new_thread = threading.Thread(target=self.thread_proc, args=(switch_id,), daemon=True)
-            # Start the new thread
-            new_thread.start()
+            self.last_update_times[switch_id] = self.clock()
+            self.start_timeout_thread(switch_id)
             # Wait a moment to prevent all switches from timing out at the same time
             # time.sleep(0.3)
-        # Send the route updates out
-        for switch_id in range(self.total_switches):
-            self.send_route_update(switch_id)
+        self.bootstrapped = True
+        # Send the route updates out, the timeout threads are already running
+        with self.lock:
+            for switch_id in range(self.total_switches):
+                self.send_route_update(switch_id)
 
     def await_messages(self):
         """
@@ -203,10 +254,16 @@ class Controller:
         create a new thread that manages checking if TIMEOUT has happened.
         """
         data, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
-        data = data.decode("utf-8")
+        self.handle_message(data.decode("utf-8"), addr)
+
+    def handle_message(self, data, addr):
+        """
+        Handle a single decoded message received from a switch.
+        """
         # Check if it is a register request
         if "Register_Request" in data:
-            switch_id = int(data[0])
+            switch_id = int(data.split(" ")[0])
+            self.recorder.record("recv", "register_request", switch_id, len(data))
             print("Received Register Request: %s" % data)
             print(addr)
             print(switch_id)
@@ -218,124 +275,255 @@ class Controller:
             # Log that the switch is now alive
             topology_update_switch_alive(switch_id)
             # Start keeping track of time involved in TIMEOUT
-            self.last_update_times[switch_id] = time.time()
+            self.last_update_times[switch_id] = self.clock()
             # Send register response
             self.send_register_response(switch_id)
-            self.switch_statuses[switch_id] = True
-            for neighbor_id in self.neighbors[switch_id]:
-                # Only if the neighbor is also online, then update the lengths
-                if self.switch_statuses[neighbor_id]:
-                    self.lengths[(neighbor_id, switch_id)] = self.original_lengths[(neighbor_id, switch_id)]
-                    self.lengths[(switch_id, neighbor_id)] = self.original_lengths[(switch_id, neighbor_id)]
-            # Since the switch was previously offline, we will have a new topology. Once registered, send it out.
-            self.compute_routes()
-            for switch_id in range(self.total_switches):
-                self.send_route_update(switch_id)
-            # Create a new thread
-            new_thread = threading.Thread(target=self.thread_proc, args=(switch_id,), daemon=True)
-            # Start the new thread
-            new_thread.start()
+            with self.lock:
+                self.switch_statuses[switch_id] = True
+                for neighbor_id in self.neighbors[switch_id]:
+                    # Round trip times measured before the switch went offline no longer apply
+                    self.link_rtts.pop((switch_id, neighbor_id), None)
+                    self.link_rtts.pop((neighbor_id, switch_id), None)
+                    # Only if the neighbor is also online, then update the lengths
+                    if self.switch_statuses[neighbor_id]:
+                        self.lengths[(neighbor_id, switch_id)] = self.link_length(neighbor_id, switch_id)
+                        self.lengths[(switch_id, neighbor_id)] = self.link_length(switch_id, neighbor_id)
+                # Since the switch was previously offline, we will have a new topology. Once registered, send it out.
+                self.compute_routes()
+                for other_id in range(self.total_switches):
+                    self.send_route_update(other_id)
+            self.start_timeout_thread(switch_id)
         # Otherwise it is a topology update
         else:
-            switch_id = int(data[0])
+            lines = data.split("\n")
+            switch_id = int(lines[0])
+            self.recorder.record("recv", "topology_update", switch_id, len(data))
             print(f"Topology update received from switch id {switch_id}")
             # Update the last update times
-            self.last_update_times[switch_id] = time.time()
-            topology_update = False
-            # Skip the first and last items. First is the switch id, last is a newline at the end
-            for line in data.split("\n")[1:-1]:
-                neighbor_id = int(line[0])
-                alive = True if "True" in line else False
-                # If the link was previously dead and is now alive, we have a new topology
-                if self.lengths[(switch_id, neighbor_id)] == 9999 and alive:
-                    print(f"Link from {switch_id} to {neighbor_id} restored -> Topology Update")
-                    # Update the length to be correct now
-                    self.lengths[(switch_id, neighbor_id)] = self.original_lengths[(switch_id, neighbor_id)]
-                    self.lengths[(neighbor_id, switch_id)] = self.original_lengths[(switch_id, neighbor_id)]
-                    topology_update = True
-                # Otherwise if the link was previously alive and now is dead, we have a new topology
-                elif self.lengths[(switch_id, neighbor_id)] != 9999 and not alive:
-                    print(f"Link from {switch_id} to {neighbor_id} dead -> Topology Update")
-                    # Update the length to be correct now
-                    self.lengths[(switch_id, neighbor_id)] = 9999
-                    self.lengths[(neighbor_id, switch_id)] = 9999
-                    topology_update = True
-                    # Log that this happened
-                    topology_update_link_dead(switch_id, neighbor_id)
-
-            # If there is a change in topology, send it out to all the switches
-            if topology_update:
-                self.compute_routes()
-                for switch_id in range(self.total_switches):
-                    self.send_route_update(switch_id)
+            self.last_update_times[switch_id] = self.clock()
+            with self.lock:
+                topology_update = False
+                # Skip the first and last items. First is the switch id, last is a newline at the end
+                for line in lines[1:-1]:
+                    parts = line.split(" ")
+                    neighbor_id = int(parts[0])
+                    alive = parts[1] == "True"
+                    # Switches without latency measurement do not send a round trip time. -1 means not measured yet.
+                    rtt = float(parts[2]) if len(parts) > 2 else -1
+                    if alive and rtt >= 0:
+                        self.link_rtts[(switch_id, neighbor_id)] = rtt
+                    else:
+                        self.link_rtts.pop((switch_id, neighbor_id), None)
+                    # If the link was previously dead and is now alive, we have a new topology
+                    if self.lengths[(switch_id, neighbor_id)] == 9999 and alive:
+                        print(f"Link from {switch_id} to {neighbor_id} restored -> Topology Update")
+                        # Update the length to be correct now
+                        self.lengths[(switch_id, neighbor_id)] = self.link_length(switch_id, neighbor_id)
+                        self.lengths[(neighbor_id, switch_id)] = self.link_length(switch_id, neighbor_id)
+                        topology_update = True
+                    # Otherwise if the link was previously alive and now is dead, we have a new topology
+                    elif self.lengths[(switch_id, neighbor_id)] != 9999 and not alive:
+                        print(f"Link from {switch_id} to {neighbor_id} dead -> Topology Update")
+                        # Update the length to be correct now
+                        self.lengths[(switch_id, neighbor_id)] = 9999
+                        self.lengths[(neighbor_id, switch_id)] = 9999
+                        topology_update = True
+                        # Log that this happened
+                        topology_update_link_dead(switch_id, neighbor_id)
+                    # Otherwise the link is still alive. When routing on latency, follow its measured latency once it moved far enough.
+                    elif alive and self.latency_weight:
+                        current = self.lengths[(switch_id, neighbor_id)]
+                        length = self.link_length(switch_id, neighbor_id)
+                        if abs(length - current) > LATENCY_HYSTERESIS * current:
+                            print(f"Link from {switch_id} to {neighbor_id} length {current} -> {length} -> Topology Update")
+                            self.lengths[(switch_id, neighbor_id)] = length
+                            self.lengths[(neighbor_id, switch_id)] = length
+                            topology_update = True
+
+                # If there is a change in topology, send it out to all the switches
+                if topology_update:
+                    self.compute_routes()
+                    for other_id in range(self.total_switches):
+                        self.send_route_update(other_id)
+
+    def link_length(self, switch_id, neighbor_id):
+        """
+        The length a working link should have. This is its length from the config file, plus its round trip time
+        (averaged over what both ends reported) scaled by latency_weight when routing on latency.
+        """
+        length = self.original_lengths[(switch_id, neighbor_id)]
+        rtts = [self.link_rtts[link] for link in ((switch_id, neighbor_id), (neighbor_id, switch_id)) if link in self.link_rtts]
+        if self.latency_weight and rtts:
+            length += round(self.latency_weight * 1000 * sum(rtts) / len(rtts))
+        # 9999 means the link is dead, so a working link must stay below it
+        return min(length, 9998)
+
+    def start_timeout_thread(self, switch_id):
+        """
+        Start a thread that manages checking if TIMEOUT has happened for the given switch id.
+        """
+        new_thread = threading.Thread(target=self.thread_proc, args=(switch_id,), daemon=True)
+        new_thread.start()
 
     def thread_proc(self, switch_id):
         """
         The method to be passed as the run method for new threads created each register request.
         """
-        time_elapsed = time.time() - self.last_update_times[switch_id]
+        time_elapsed = self.clock() - self.last_update_times[switch_id]
         while time_elapsed < TIMEOUT:
             # Wait until the TIMEOUT might have happened
             time.sleep(TIMEOUT - time_elapsed)
-            time_elapsed = time.time() - self.last_update_times[switch_id]
+            time_elapsed = self.clock() - self.last_update_times[switch_id]
         # If we have broken out of the while loop above, the switch has TIMED OUT -> Switch is dead
-        # Recompute topology, send it out to all live switches, kill this thread.
+        self.handle_switch_timeout(switch_id)
+
+    def handle_switch_timeout(self, switch_id):
+        """
+        The switch with the given id has TIMED OUT.
+        Recompute topology, send it out to all live switches.
+        """
         print(f"SWITCH {switch_id} HAS TIMED OUT")
-        self.switch_statuses[switch_id] = False
-        topology_update_switch_dead(switch_id)
-        # Set the distances to and from the neighbors to this switch id to 9999
-        for neighbor in self.neighbors[switch_id]:
-            self.lengths[(switch_id, neighbor)] = 9999
-            self.lengths[(neighbor, switch_id)] = 9999
-        self.compute_routes()
-        for switch_id in range(self.total_switches):
-            self.send_route_update(switch_id)
+        self.recorder.record("timeout", switch_id)
+        with self.lock:
+            self.switch_statuses[switch_id] = False
+            topology_update_switch_dead(switch_id)
+            # Set the distances to and from the neighbors to this switch id to 9999
+            for neighbor in self.neighbors[switch_id]:
+                self.lengths[(switch_id, neighbor)] = 9999
+                self.lengths[(neighbor, switch_id)] = 9999
+            self.compute_routes()
+            for other_id in range(self.total_switches):
+                self.send_route_update(other_id)
 
     def compute_routes(self):
         """
         New version of computing the routes, since last one seemed to fail
         """
         #-------------------COMPUTE ROUTING TABLE-----------
+        start = time.perf_counter()
+        # Find the links whose length changed since the last time the routes were computed
+        changed_links = [(link, length) for link, length in self.lengths.items() if self.routed_lengths.get(link) != length]
+        # Details are only formatted if the flight recorder gets dumped
+        self.recorder.record("recompute_start", len(changed_links))
+        # The neighbors of each node along with the length of the link to them
+        adjacency = [[(v, self.lengths[(u, v)]) for v in self.neighbors[u]] for u in range(self.total_switches)]
+        # Find the shortest paths for each node, only revisiting the parts that could have changed
+        changed_trees = 0
+        for node_num in range(self.total_switches):
+            if self.tree_dists[node_num] is None:
+                self.compute_tree(node_num, adjacency)
+            elif not self.update_tree(node_num, adjacency, changed_links):
+                continue
+            self.route_messages[node_num] = None
+            changed_trees += 1
+        self.routed_lengths = self.lengths.copy()
         rt_table = []
-        # Find the shortest paths for each node
+        routes_by_switch = [[] for i in range(self.total_switches)]
         for node_num in range(self.total_switches):
-            dist = [1E9] * self.total_switches
-            dist[node_num] = 0
-            prev = [node_num] * self.total_switches
-            q = []
-            heappush(q, (0, node_num))
-            while q != []:
-                _, u = heappop(q)
-                for v in self.neighbors[u]:
-                    alt = dist[u] + self.lengths[(u, v)]
-                    if alt < dist[v]:
-                        dist[v] = alt
-                        prev[v] = u
-                        if v not in q:
-                            heappush(q, (alt, v))
-            # Done computing paths for this node, add to table
-            for dest in range(self.total_switches):
-                next_hop = dest
-                length = dist[dest]
-                while prev[next_hop] != node_num:
-                    next_hop = prev[next_hop]
-                data = [node_num, dest, next_hop, length]
-                # Only if the switch is alive, add this info to the table
-                if self.switch_statuses[node_num]:
-                    rt_table.append(data)
+            # Only if the switch is alive, add its routes to the table
+            if self.switch_statuses[node_num]:
+                rt_table.extend(self.tree_routes[node_num])
+                routes_by_switch[node_num] = self.tree_routes[node_num]
         #-------------DONE COMPUTING ROUTING TABLE-----------------
-        # Update destinations and distances of entries with distance >= 9999
-        for row in rt_table:
-            if row[3] >= 9999:
-                row[2] = -1
-                row[3] = 9999
 
         self.rt_table = rt_table
+        self.publish_routes(routes_by_switch)
+        # The number of trees that changed and how many seconds the recompute took
+        self.recorder.record("recompute_stop", changed_trees, time.perf_counter() - start)
         print("Routing:")
         print(rt_table)
         # Log that we computed the routing table
         routing_table_update(rt_table)
 
+    def compute_tree(self, node_num, adjacency):
+        """
+        Compute the shortest path tree from the given node from scratch.
+        """
+        self.tree_dists[node_num] = [1E9] * self.total_switches
+        self.tree_dists[node_num][node_num] = 0
+        # -1 means no parent, which is the case for the node itself and unreachable nodes
+        self.tree_parents[node_num] = [-1] * self.total_switches
+        self.tree_first_hops[node_num] = list(range(self.total_switches))
+        self.tree_routes[node_num] = [[node_num, dest, -1, 9999] for dest in range(self.total_switches)]
+        self.run_dijkstra(node_num, adjacency, [(0, node_num)])
+
+    def update_tree(self, node_num, adjacency, changed_links):
+        """
+        Update the shortest path tree from the given node after the lengths of the given links changed.
+        Only the nodes below a tree link that got longer, or reached more cheaply through a link that got shorter, are revisited.
+        Returns whether the tree changed.
+        """
+        dist = self.tree_dists[node_num]
+        parent = self.tree_parents[node_num]
+        # Nodes whose tree link got longer, everything below them has to find a new path
+        roots = [v for (u, v), length in changed_links if length > self.routed_lengths[(u, v)] and parent[v] == u]
+        affected = set()
+        if roots:
+            children = [[] for i in range(self.total_switches)]
+            for child, p in enumerate(parent):
+                if p != -1:
+                    children[p].append(child)
+            while roots:
+                x = roots.pop()
+                if x not in affected:
+                    affected.add(x)
+                    roots.extend(children[x])
+        q = []
+        for x in affected:
+            dist[x] = 1E9
+            parent[x] = -1
+            self.tree_first_hops[node_num][x] = x
+        # Give each affected node the best path through a node that was not affected
+        for x in affected:
+            for y, length in adjacency[x]:
+                if y not in affected and dist[y] + length < dist[x]:
+                    dist[x] = dist[y] + length
+                    parent[x] = y
+            if dist[x] < 1E9:
+                heappush(q, (dist[x], x))
+        # Links that got shorter may give shorter paths
+        for (u, v), length in changed_links:
+            if length < self.routed_lengths[(u, v)] and dist[u] + length < dist[v]:
+                dist[v] = dist[u] + length
+                parent[v] = u
+                heappush(q, (dist[v], v))
+        changed = bool(affected or q)
+        if changed:
+            # Copy the routes before changing them, queries may still be reading the previous table
+            routes = self.tree_routes[node_num] = self.tree_routes[node_num].copy()
+            for x in affected:
+                routes[x] = [node_num, x, -1, 9999]
+            self.run_dijkstra(node_num, adjacency, q)
+        return changed
+
+    def run_dijkstra(self, node_num, adjacency, q):
+        """
+        Run Dijkstra's algorithm on the shortest path tree from the given node, starting from the entries in q.
+        Every node whose distance is settled gets its first hop and route updated.
+        """
+        dist = self.tree_dists[node_num]
+        parent = self.tree_parents[node_num]
+        first_hop = self.tree_first_hops[node_num]
+        routes = self.tree_routes[node_num]
+        while q != []:
+            d, u = heappop(q)
+            # Skip stale queue entries, u was already reached with a shorter distance
+            if d > dist[u]:
+                continue
+            p = parent[u]
+            first_hop[u] = u if p == node_num or p == -1 else first_hop[p]
+            # Destinations with distance >= 9999 can't be reached
+            if d >= 9999:
+                routes[u] = [node_num, u, -1, 9999]
+            else:
+                routes[u] = [node_num, u, first_hop[u], d]
+            for v, length in adjacency[u]:
+                alt = d + length
+                if alt < dist[v]:
+                    dist[v] = alt
+                    parent[v] = u
+                    heappush(q, (alt, v))
+
     def compute_routes2(self):
         """
         Compute the routing table based on the information in the config file.
@@ -379,20 +567,58 @@ class Controller:
                 row[3] = 9999
 
         self.rt_table = rt_table
+        self.index_routes()
         print("Routing:")
         print(rt_table)
         # Log that we computed the routing table
         routing_table_update(rt_table)
 
+    def index_routes(self):
+        """
+        Group the rows of the routing table by the switch they go out from, so that sending
+        a route update does not need to scan the whole table.
+        """
+        routes_by_switch = [[] for i in range(self.total_switches)]
+        for row in self.rt_table:
+            routes_by_switch[row[0]].append(row)
+        self.publish_routes(routes_by_switch)
+
+    def publish_routes(self, routes_by_switch):
+        """
+        Make the routes grouped by switch the current table, for route updates and route queries.
+        The table version goes up when any routes changed so that paths memoized for the previous table are dropped.
+        """
+        self.routes_by_switch = routes_by_switch
+        version, old_routes_by_switch = self.route_snapshot
+        # Trees that did not change keep the same list of routes, and dead switches have none
+        if any(routes is not old_routes and (routes or old_routes)
+               for routes, old_routes in zip(routes_by_switch, old_routes_by_switch)):
+            version += 1
+        # Queries read the version and the table together from this one attribute
+        self.route_snapshot = (version, routes_by_switch)
+
+    def build_route_message(self, switch_id, routes):
+        """
+        Build the route update message for the given switch from its rows of the routing table.
+        """
+        message = f"{switch_id}\n"
+        message += "".join(f"{row[1]} {row[2]}\n" for row in routes)
+        return message
+
     def send_route_update(self, switch_id):
         """
         Send the routing information that the particular switch will need.
         """
-        message = f"{switch_id}\n"
-        for row in self.rt_table:
-            if row[0] == switch_id:
-                message += f"{row[1]} {row[2]}\n"
+        routes = self.routes_by_switch[switch_id]
+        # Only messages built from a tree are kept, dead switches get a message without routes
+        if routes and routes is self.tree_routes[switch_id]:
+            if self.route_messages[switch_id] is None:
+                self.route_messages[switch_id] = self.build_route_message(switch_id, routes)
+            message = self.route_messages[switch_id]
+        else:
+            message = self.build_route_message(switch_id, routes)
         b_message = message.encode("utf-8")
+        self.recorder.record("send", "route_update", switch_id, len(b_message))
         self.sock.sendto(b_message, ("localhost", self.switch_ports[switch_id]))
 
     def send_register_response(self, switch_id):
@@ -404,19 +630,134 @@ class Controller:
         for neighbor in neighbors:
             message += f"{neighbor} localhost {self.switch_ports[neighbor]}\n"
         b_message = message.encode("utf-8")
+        self.recorder.record("send", "register_response", switch_id, len(b_message))
         self.sock.sendto(b_message, ("localhost", self.switch_ports[switch_id]))
         # Log that the register response was sent
         register_response_sent(switch_id)
 
+    def start_query_thread(self, query_port):
+        """
+        Start a thread answering route queries on its own loopback port,
+        so that queries never hold up the topology updates arriving on the main socket.
+        """
+        query_sock = socket(AF_INET, SOCK_DGRAM)
+        query_sock.bind(("localhost", query_port))
+        new_thread = threading.Thread(target=self.thread_query, args=(query_sock,), daemon=True)
+        new_thread.start()
+
+    def thread_query(self, query_sock):
+        """
+        The method to be passed as the run method for the route query thread.
+        """
+        while True:
+            data, addr = query_sock.recvfrom(65535) # the largest UDP datagram
+            try:
+                response = self.answer_queries(data.decode("utf-8"))
+            except UnicodeDecodeError:
+                query_sock.sendto(b"ERROR queries must be UTF-8 text\n", addr)
+                continue
+            try:
+                query_sock.sendto(response.encode("utf-8"), addr)
+            except OSError:
+                query_sock.sendto(b"ERROR response too large, send fewer queries at once\n", addr)
+
+    def answer_queries(self, data):
+        """
+        Answer a datagram of route queries, one per line:
+            NEXT_HOP <Switch ID> <Dest ID>  ->  <Switch ID> <Dest ID> <Next Hop>
+            DISTANCE <Switch ID> <Dest ID>  ->  <Switch ID> <Dest ID> <Shortest distance>
+            PATH <Switch ID> <Dest ID>      ->  <Switch ID> <Dest ID> <Switch ID> <Hop> ... <Dest ID>
+        The response starts with the version of the routing table all the answers come from, followed by
+        one line per query in the same order. Like the routing table, a destination that can't be reached
+        has a next hop of -1 and a distance of 9999, and its path is -1. Queries that can't be parsed get ERROR <query>.
+        """
+        version, routes_by_switch = self.route_snapshot
+        response = [f"{version}\n"]
+        for line in data.split("\n"):
+            parts = line.split()
+            if not parts:
+                continue
+            try:
+                if len(parts) != 3:
+                    raise ValueError(line)
+                src = int(parts[1])
+                dst = int(parts[2])
+                if not 0 <= src < self.total_switches or not 0 <= dst < self.total_switches:
+                    raise ValueError(line)
+            except ValueError:
+                response.append(f"ERROR {line}\n")
+                continue
+            # Dead switches have no routes
+            row = routes_by_switch[src][dst] if routes_by_switch[src] else [src, dst, -1, 9999]
+            if parts[0] == "NEXT_HOP":
+                response.append(f"{src} {dst} {row[2]}\n")
+            elif parts[0] == "DISTANCE":
+                response.append(f"{src} {dst} {row[3]}\n")
+            elif parts[0] == "PATH":
+                path = self.find_path(version, routes_by_switch, src, dst)
+                response.append(f"{src} {dst} {' '.join(str(hop) for hop in path) if path else -1}\n")
+            else:
+                response.append(f"ERROR {line}\n")
+        return "".join(response)
+
+    def find_path(self, version, routes_by_switch, src, dst):
+        """
+        Find the hop by hop path from src to dst by following the next hops, as a tuple starting with src
+        and ending with dst, or None if dst can't be reached. The path from every switch along the way is
+        memoized until the routing table version changes.
+        """
+        # Dead switches have no routes, not even to themselves
+        if not routes_by_switch[src]:
+            return None
+        cache_version, cache = self.path_cache
+        if cache_version != version:
+            cache = {}
+            self.path_cache = (version, cache)
+        # Follow the next hops until a switch whose path is already known
+        hops = []
+        switch_id = src
+        while (switch_id, dst) not in cache:
+            if switch_id == dst:
+                cache[(dst, dst)] = (dst,)
+                break
+            routes = routes_by_switch[switch_id]
+            # Stop at dead switches, unreachable destinations, and loops (which a consistent table never has)
+            if not routes or routes[dst][2] == -1 or len(hops) > self.total_switches:
+                cache[(switch_id, dst)] = None
+                break
+            hops.append(switch_id)
+            switch_id = routes[dst][2]
+        # Memoize the path from each switch that was passed on the way
+        path = cache[(switch_id, dst)]
+        for switch_id in reversed(hops):
+            if path is not None:
+                path = (switch_id,) + path
+            cache[(switch_id, dst)] = path
+        return path
+
 
 def main():
     #Check for number of arguments and exit if host/port not provided
     num_args = len(sys.argv)
-    if num_args < 3:
-        print ("Usage: python controller.py <port> <config file>\n")
+    if num_args < 3 or num_args % 2 == 0:
+        print ("Usage: python controller.py <port> <config file> [-l <latency weight>] [-q <query port>]\n")
         sys.exit(1)
 
-    controller = Controller(int(sys.argv[1]), sys.argv[2])
+    # The optional flags each take one value
+    options = dict(zip(sys.argv[3::2], sys.argv[4::2]))
+    # Check if we have the -l flag, route on a blend of the configured lengths and measured latency if so
+    if "-l" in options:
+        latency_weight = float(options["-l"])
+        print(f"Routing on latency with weight {latency_weight} per millisecond")
+        controller = Controller(int(sys.argv[1]), sys.argv[2], latency_weight=latency_weight)
+    else:
+        controller = Controller(int(sys.argv[1]), sys.argv[2])
+    # Check if we have the -q flag, answer route queries on that port if so
+    if "-q" in options:
+        controller.start_query_thread(int(options["-q"]))
+    # SIGUSR1 dumps the flight recorder, SIGUSR2 starts or stops profiling
+    profiler = SamplingProfiler(["await_messages", "compute_routes"])
+    install_signal_handlers(controller.recorder, profiler, "Controller.flight.log", "Controller.profile.log")
     # Run the bootstrap process of the controller. This creates other threads automatically.
     controller.bootstrap()
     # Wait for messages to show up from the switches
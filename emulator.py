@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+
+"""In-process discrete-event emulator for the controller and switches.
+
+Runs the real Controller and Switch logic against each other over an in-memory transport
+driven by a virtual clock, so thousands of switches and minutes of simulated time can be
+tested in seconds without starting one process per switch.
+
+Usage: python emulator.py [-n <switches>] [-d <seconds>] [-l <latency weight>] [--fail-link <time> <id 1> <id 2>] [--kill <time> <id>] ...
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from heapq import heappush, heappop
+
+import controller
+import switch
+from controller import Controller, K, TIMEOUT
+from flight_recorder import FlightRecorder
+from switch import Switch
+
+CONTROLLER_PORT = 3000
+# One way delay of every message sent over the in-memory transport, in seconds
+LATENCY = 0.001
+# The receive buffer size of the controller and switch sockets. Longer datagrams are cut off like recvfrom(1024) would.
+RECEIVE_BUFFER_SIZE = 1024
+# Flight recorder size of each switch, smaller than a real switch's since thousands of them share one process
+FLIGHT_RECORDER_SIZE = 64
+
+
+def silence_output():
+    """
+    Stop the controller and switch modules from printing and writing log files.
+    With thousands of switches this output would dominate the run time.
+    """
+    def no_op(*args, **kwargs):
+        pass
+    for module in (controller, switch):
+        module.print = no_op
+        module.write_to_log = no_op
+        # Formatting a routing table with millions of rows is slow even when it is never written
+        module.routing_table_update = no_op
+
+
+def generate_config(num_switches, degree, seed=0):
+    """
+    Generate the lines of a connected random topology in the config file format.
+    The switches are put in a ring first, then random links are added until the average degree is reached.
+    """
+    rng = random.Random(seed)
+    links = set()
+    for node in range(1, num_switches):
+        links.add((node - 1, node))
+    if num_switches > 2:
+        links.add((0, num_switches - 1))
+    # A topology cannot have more links than there are pairs of switches
+    num_links = min(max(len(links), num_switches * degree // 2), num_switches * (num_switches - 1) // 2)
+    while len(links) < num_links:
+        node1, node2 = sorted(rng.sample(range(num_switches), 2))
+        links.add((node1, node2))
+    lines = [f"{num_switches}\n"]
+    for node1, node2 in sorted(links):
+        lines.append(f"{node1} {node2} {rng.randint(10, 200)}\n")
+    # The controller does not expect a newline after the last link
+    lines[-1] = lines[-1].rstrip("\n")
+    return lines
+
+
+class VirtualSocket:
+    """
+    Stands in for a UDP socket, handing every datagram to the emulator instead of the OS.
+    """
+
+    def __init__(self, emulator, port):
+        self.emulator = emulator
+        self.port = port
+
+    def sendto(self, b_message, addr):
+        self.emulator.transmit(self.port, addr[1], b_message)
+
+    def recvfrom(self, bufsize):
+        raise RuntimeError("The emulator delivers messages itself, blocking receives are not supported")
+
+
+class EmulatedController(Controller):
+
+    def __init__(self, emulator, config_file, latency_weight=0):
+        super().__init__(CONTROLLER_PORT, config_file, sock=VirtualSocket(emulator, CONTROLLER_PORT), latency_weight=latency_weight)
+        self.emulator = emulator
+        self.clock = emulator.clock
+        self.recorder.clock = emulator.clock
+
+    def receive(self, data, addr):
+        """
+        Handle a message delivered by the emulator, the same way bootstrap() and await_messages() would.
+        """
+        if self.bootstrapped:
+            self.handle_message(data, addr)
+        elif "Register_Request" in data:
+            self.handle_bootstrap_request(data, addr)
+            if self.num_online_switches == self.total_switches:
+                self.finish_bootstrap()
+
+    def start_timeout_thread(self, switch_id):
+        self.emulator.schedule(TIMEOUT, self.check_timeout, switch_id)
+
+    def check_timeout(self, switch_id):
+        """
+        One iteration of thread_proc on the virtual clock.
+        """
+        # Compare against the deadline itself, recomputing the remaining time could round to zero and never advance
+        deadline = self.last_update_times[switch_id] + TIMEOUT
+        if self.clock() < deadline:
+            self.emulator.schedule_at(deadline, self.check_timeout, switch_id)
+        else:
+            self.handle_switch_timeout(switch_id)
+
+    def compute_routes(self):
+        start = time.perf_counter()
+        super().compute_routes()
+        self.emulator.stats["recomputes"] += 1
+        self.emulator.stats["recompute_seconds"] += time.perf_counter() - start
+
+
+class EmulatedSwitch(Switch):
+
+    def __init__(self, emulator, switch_id, port):
+        super().__init__(switch_id, CONTROLLER_PORT, sock=VirtualSocket(emulator, port))
+        self.emulator = emulator
+        self.port = port
+        self.clock = emulator.clock
+        self.recorder = FlightRecorder(FLIGHT_RECORDER_SIZE, emulator.clock)
+        # Cleared when the emulator kills this switch, which stops all of its pending timers
+        self.alive = True
+        self.last_route_update = None
+
+    def receive(self, data, addr):
+        """
+        Handle a message delivered by the emulator, the same way bootstrap() and await_messages() would.
+        """
+        if self.neighbor_addrs is None:
+            self.handle_register_response(data)
+            self.start_threads()
+            return
+        if "KEEP_ALIVE" not in data and data != self.last_route_update:
+            self.last_route_update = data
+            self.emulator.last_route_change = self.emulator.now
+        self.handle_message(data, addr)
+
+    def start_threads(self):
+        self.emulator.schedule(K, self.keep_alive_tick)
+        for neighbor_id in self.neighbor_ids_to_index.keys():
+            self.start_timeout_thread(neighbor_id)
+
+    def start_timeout_thread(self, neighbor_id):
+        self.emulator.schedule(TIMEOUT, self.check_timeout, neighbor_id)
+
+    def keep_alive_tick(self):
+        """
+        One iteration of thread_keep_alive on the virtual clock.
+        """
+        if not self.alive:
+            return
+        self.send_topology_update()
+        self.send_keep_alive()
+        self.emulator.schedule(K, self.keep_alive_tick)
+
+    def check_timeout(self, neighbor_id):
+        """
+        One iteration of thread_proc on the virtual clock.
+        """
+        if not self.alive:
+            return
+        neighbor_index = self.neighbor_ids_to_index[neighbor_id]
+        deadline = self.last_update_times[neighbor_index] + TIMEOUT
+        if self.clock() < deadline:
+            self.emulator.schedule_at(deadline, self.check_timeout, neighbor_id)
+        else:
+            self.handle_neighbor_timeout(neighbor_id)
+
+
+class Emulator:
+
+    def __init__(self, config_file, seed=0, latency_weight=0):
+        self.now = 0.0
+        self.rng = random.Random(seed)
+        # Heap of (time, sequence number, callback, args). The sequence number keeps equal times in FIFO order.
+        self.events = []
+        self.seq = 0
+        self.stats = {"control_messages": 0, "keep_alives": 0, "truncated": 0, "recomputes": 0, "recompute_seconds": 0.0}
+        self.last_route_change = 0.0
+        # Objects that can receive messages, indexed by port
+        self.endpoints = {}
+        self.next_port = CONTROLLER_PORT + 1
+        # The switch id listening on each port, and the extra one way delay of each (switch id, switch id) link
+        self.port_ids = {}
+        self.link_delays = {}
+
+        self.controller = EmulatedController(self, config_file, latency_weight)
+        self.endpoints[CONTROLLER_PORT] = self.controller
+        self.switches = [None] * self.controller.total_switches
+        # Scripted events as (time, description, callback, args) and their measurements once run
+        self.script = []
+        self.results = []
+
+    def clock(self):
+        return self.now
+
+    def schedule(self, delay, callback, *args):
+        self.schedule_at(self.now + delay, callback, *args)
+
+    def schedule_at(self, at, callback, *args):
+        heappush(self.events, (at, self.seq, callback, args))
+        self.seq += 1
+
+    def transmit(self, src_port, dst_port, b_message):
+        """
+        Send a datagram from one port to another. Datagrams to ports nobody listens on are dropped.
+        """
+        if CONTROLLER_PORT in (src_port, dst_port):
+            self.stats["control_messages"] += 1
+        elif b" KEEP_ALIVE" in b_message:
+            self.stats["keep_alives"] += 1
+        delay = LATENCY + self.link_delays.get((self.port_ids.get(src_port), self.port_ids.get(dst_port)), 0.0)
+        self.schedule(delay, self.deliver, src_port, dst_port, b_message)
+
+    def deliver(self, src_port, dst_port, b_message):
+        endpoint = self.endpoints.get(dst_port)
+        if endpoint is not None:
+            # The real sockets only read the start of a datagram too long for their buffer, and the rest is lost
+            if len(b_message) > RECEIVE_BUFFER_SIZE:
+                self.stats["truncated"] += 1
+                b_message = b_message[:RECEIVE_BUFFER_SIZE]
+            endpoint.receive(b_message.decode("utf-8"), ("localhost", src_port))
+
+    #------------------SCRIPTED EVENTS------------------
+
+    def start_switch(self, switch_id):
+        """
+        Start (or restart) the switch with the given id on a fresh port and send its register request.
+        """
+        if self.switches[switch_id] is not None:
+            self.kill_switch(switch_id)
+        new_switch = EmulatedSwitch(self, switch_id, self.next_port)
+        self.endpoints[self.next_port] = new_switch
+        self.port_ids[self.next_port] = switch_id
+        self.next_port += 1
+        self.switches[switch_id] = new_switch
+        new_switch.send_register_request(wait=False)
+
+    def kill_switch(self, switch_id):
+        old_switch = self.switches[switch_id]
+        # Nothing to kill if the switch was never started
+        if old_switch is None:
+            return
+        old_switch.alive = False
+        self.endpoints.pop(old_switch.port, None)
+
+    def fail_link(self, switch_id, neighbor_id):
+        # Same as starting switch_id with the -f flag
+        if self.switches[switch_id] is not None:
+            self.switches[switch_id].failed_link_neighbor_id = neighbor_id
+
+    def restore_link(self, switch_id, neighbor_id):
+        # A switch only fails one link at a time, leave it failed if this is not that link
+        if self.switches[switch_id] is None or self.switches[switch_id].failed_link_neighbor_id != neighbor_id:
+            print(f"{self.now:.2f}: the link from {switch_id} to {neighbor_id} was not failed, nothing to restore")
+            return
+        self.switches[switch_id].failed_link_neighbor_id = -1
+
+    def slow_link(self, switch_id, neighbor_id, delay):
+        """
+        Add the given one way delay in seconds to the link in both directions, on top of LATENCY.
+        """
+        self.link_delays[(switch_id, neighbor_id)] = delay
+        self.link_delays[(neighbor_id, switch_id)] = delay
+
+    def add_event(self, at, description, callback, *args):
+        self.script.append((at, description, callback, args))
+
+    #------------------------RUN------------------------
+
+    def run_until(self, end_time):
+        while self.events and self.events[0][0] <= end_time:
+            self.now, _, callback, args = heappop(self.events)
+            callback(*args)
+        self.now = end_time
+
+    def run(self, duration):
+        """
+        Start all switches, run the scripted events and measure each of them until the next one happens.
+        Returns a list of dicts, one per event.
+        """
+        script = [(0.0, "bootstrap", self.start_all, ())]
+        script += sorted((event for event in self.script if event[0] < duration), key=lambda event: event[0])
+        for i, (at, description, callback, args) in enumerate(script):
+            self.run_until(at)
+            before = dict(self.stats)
+            self.last_route_change = None
+            callback(*args)
+            end_time = script[i + 1][0] if i + 1 < len(script) else duration
+            self.run_until(end_time)
+            result = {"time": at, "event": description}
+            for key, value in self.stats.items():
+                result[key] = value - before[key]
+            result["convergence"] = None if self.last_route_change is None else self.last_route_change - at
+            self.results.append(result)
+        return self.results
+
+    def start_all(self):
+        for switch_id in range(len(self.switches)):
+            # Stagger the register requests slightly like separately started processes
+            self.schedule(self.rng.uniform(0, 0.01), self.start_switch, switch_id)
+
+    #----------------------VERIFY-----------------------
+
+    def verify_routes(self, rounds, samples=20):
+        """
+        Check the controller's incremental route computation against a from scratch Dijkstra over rounds of random
+        link length changes and switch deaths. In each round the distances and next hops of every route are checked,
+        along with the paths and cached route update messages of a sample of switches.
+        Prints the mismatches and returns whether there were none.
+        """
+        controller = self.controller
+        controller.switch_statuses = [True] * controller.total_switches
+        controller.compute_routes()
+        links = [link for link in controller.lengths if link[0] < link[1]]
+        mismatches = []
+        for round_num in range(rounds):
+            for i in range(self.rng.randint(1, 5)):
+                node1, node2 = self.rng.choice(links)
+                # The links of dead switches stay at 9999 until they come back
+                if not controller.switch_statuses[node1] or not controller.switch_statuses[node2]:
+                    continue
+                length = self.rng.choice([9999, controller.original_lengths[(node1, node2)], self.rng.randint(1, 300)])
+                controller.lengths[(node1, node2)] = controller.lengths[(node2, node1)] = length
+            # Now and then kill or revive a switch, setting the lengths of its links like the controller does
+            if self.rng.random() < 0.2:
+                switch_id = self.rng.randrange(controller.total_switches)
+                alive = not controller.switch_statuses[switch_id]
+                controller.switch_statuses[switch_id] = alive
+                for neighbor_id in controller.neighbors[switch_id]:
+                    length = controller.original_lengths[(switch_id, neighbor_id)] if alive and controller.switch_statuses[neighbor_id] else 9999
+                    controller.lengths[(switch_id, neighbor_id)] = controller.lengths[(neighbor_id, switch_id)] = length
+            controller.compute_routes()
+            mismatches.extend(f"round {round_num}: {mismatch}" for mismatch in self.check_routes(samples))
+            # The emulator is not running, drop the route updates sent while checking the message cache
+            self.events.clear()
+        for mismatch in mismatches[:20]:
+            print(mismatch)
+        print(f"{rounds} rounds on {controller.total_switches} switches, {len(mismatches)} mismatches")
+        return not mismatches
+
+    def check_routes(self, samples):
+        """
+        Compare the controller's current routes with a from scratch Dijkstra, returning a list of mismatches.
+        """
+        controller = self.controller
+        version, routes_by_switch = controller.route_snapshot
+        dists = [shortest_distances(controller, src) for src in range(controller.total_switches)]
+        mismatches = []
+        expected_rows = 0
+        for src in range(controller.total_switches):
+            if not controller.switch_statuses[src]:
+                if routes_by_switch[src]:
+                    mismatches.append(f"dead switch {src} has routes")
+                continue
+            expected_rows += controller.total_switches
+            for row in routes_by_switch[src]:
+                _, dst, next_hop, dist = row
+                expected = dists[src][dst] if dists[src][dst] < 9999 else 9999
+                if dist != expected:
+                    mismatches.append(f"{src} -> {dst} distance {dist}, expected {expected}")
+                elif dist == 9999 and next_hop != -1:
+                    mismatches.append(f"{src} -> {dst} is unreachable but has next hop {next_hop}")
+                elif dist < 9999 and src != dst and (next_hop not in controller.neighbors[src]
+                                                     or controller.lengths[(src, next_hop)] + dists[next_hop][dst] != dist):
+                    mismatches.append(f"{src} -> {dst} next hop {next_hop} is not on a shortest path")
+        if len(controller.rt_table) != expected_rows:
+            mismatches.append(f"routing table has {len(controller.rt_table)} rows, expected {expected_rows}")
+        for src in self.rng.sample(range(controller.total_switches), min(samples, controller.total_switches)):
+            dst = self.rng.randrange(controller.total_switches)
+            path = controller.find_path(version, routes_by_switch, src, dst)
+            dist = routes_by_switch[src][dst][3] if routes_by_switch[src] else 9999
+            if path is None:
+                if dist != 9999:
+                    mismatches.append(f"{src} -> {dst} has no path but distance {dist}")
+            elif path[0] != src or path[-1] != dst or \
+                    sum(controller.lengths[(path[i], path[i + 1])] for i in range(len(path) - 1)) != dist:
+                mismatches.append(f"{src} -> {dst} path {path} does not match distance {dist}")
+            controller.send_route_update(src)
+            message = controller.route_messages[src]
+            if message is not None and message != controller.build_route_message(src, controller.tree_routes[src]):
+                mismatches.append(f"cached route update of switch {src} is out of date")
+        return mismatches
+
+
+def shortest_distances(controller, src):
+    """
+    The shortest distance from src to every switch over the controller's current link lengths, computed from scratch.
+    """
+    dist = [1E9] * controller.total_switches
+    dist[src] = 0
+    q = [(0, src)]
+    while q:
+        d, u = heappop(q)
+        if d > dist[u]:
+            continue
+        for v in controller.neighbors[u]:
+            if d + controller.lengths[(u, v)] < dist[v]:
+                dist[v] = d + controller.lengths[(u, v)]
+                heappush(q, (dist[v], v))
+    return dist
+
+
+def print_results(results):
+    print(f"{'time':>8}  {'event':<24}{'control msgs':>13}{'keep alives':>12}{'truncated':>10}{'recomputes':>11}{'recompute s':>12}{'convergence':>12}")
+    for result in results:
+        convergence = "-" if result["convergence"] is None else f"{result['convergence']:.3f}"
+        print(f"{result['time']:>8.2f}  {result['event']:<24}{result['control_messages']:>13}{result['keep_alives']:>12}{result['truncated']:>10}"
+              f"{result['recomputes']:>11}{result['recompute_seconds']:>12.3f}{convergence:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate the controller and many switches in one process on a virtual clock.")
+    parser.add_argument("-c", "--config", help="config file to use instead of a generated topology")
+    parser.add_argument("-n", "--switches", type=int, default=1000, help="number of switches in the generated topology")
+    parser.add_argument("--degree", type=int, default=3, help="average degree of the generated topology")
+    parser.add_argument("-d", "--duration", type=float, default=120.0, help="simulated seconds to run for")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-l", "--latency-weight", type=float, default=0,
+                        help="route on latency, adding this much length per millisecond of measured round trip time")
+    parser.add_argument("--fail-link", nargs=3, type=float, action="append", default=[], metavar=("TIME", "ID1", "ID2"),
+                        help="switch ID1 stops exchanging keep alives with ID2, like the -f flag")
+    parser.add_argument("--restore-link", nargs=3, type=float, action="append", default=[], metavar=("TIME", "ID1", "ID2"))
+    parser.add_argument("--slow-link", nargs=4, type=float, action="append", default=[], metavar=("TIME", "ID1", "ID2", "DELAY"),
+                        help="add DELAY seconds of one way delay to the link between ID1 and ID2 (0 restores it)")
+    parser.add_argument("--kill", nargs=2, type=float, action="append", default=[], metavar=("TIME", "ID"))
+    parser.add_argument("--restart", nargs=2, type=float, action="append", default=[], metavar=("TIME", "ID"))
+    parser.add_argument("--verify", type=int, metavar="ROUNDS",
+                        help="instead of emulating, check the incremental route computation against a from scratch one "
+                             "over ROUNDS rounds of random link changes")
+    args = parser.parse_args()
+
+    silence_output()
+    config_file = args.config
+    if config_file is None:
+        handle, config_file = tempfile.mkstemp(suffix=".txt", text=True)
+        with os.fdopen(handle, "w") as file:
+            file.writelines(generate_config(args.switches, args.degree, args.seed))
+
+    emulator = Emulator(config_file, args.seed, args.latency_weight)
+    if args.config is None:
+        os.remove(config_file)
+    if args.verify is not None:
+        sys.exit(0 if emulator.verify_routes(args.verify) else 1)
+    total_switches = emulator.controller.total_switches
+    for option, events, num_ids in (("--fail-link", args.fail_link, 2), ("--restore-link", args.restore_link, 2),
+                                    ("--slow-link", args.slow_link, 2), ("--kill", args.kill, 1), ("--restart", args.restart, 1)):
+        for event in events:
+            for switch_id in event[1:1 + num_ids]:
+                if not switch_id.is_integer() or not 0 <= switch_id < total_switches:
+                    parser.error(f"{option}: {switch_id:g} is not a switch id from 0 to {total_switches - 1}")
+    for at, node1, node2 in args.fail_link:
+        emulator.add_event(at, f"fail link {int(node1)},{int(node2)}", emulator.fail_link, int(node1), int(node2))
+    for at, node1, node2 in args.restore_link:
+        emulator.add_event(at, f"restore link {int(node1)},{int(node2)}", emulator.restore_link, int(node1), int(node2))
+    for at, node1, node2, delay in args.slow_link:
+        emulator.add_event(at, f"slow link {int(node1)},{int(node2)} {delay * 1000:g}ms", emulator.slow_link, int(node1), int(node2), delay)
+    for at, switch_id in args.kill:
+        emulator.add_event(at, f"kill {int(switch_id)}", emulator.kill_switch, int(switch_id))
+    for at, switch_id in args.restart:
+        emulator.add_event(at, f"restart {int(switch_id)}", emulator.start_switch, int(switch_id))
+    # Without a script, fail and restore a link and then kill and restart a switch
+    if not emulator.script:
+        node2 = emulator.controller.neighbors[0][0]
+        emulator.add_event(20.0, f"fail link 0,{node2}", emulator.fail_link, 0, node2)
+        emulator.add_event(40.0, f"restore link 0,{node2}", emulator.restore_link, 0, node2)
+        emulator.add_event(60.0, "kill 1", emulator.kill_switch, 1)
+        emulator.add_event(90.0, "restart 1", emulator.start_switch, 1)
+
+    start = time.perf_counter()
+    results = emulator.run(args.duration)
+    wall_time = time.perf_counter() - start
+    print_results(results)
+    print(f"\n{len(emulator.switches)} switches, {args.duration:.1f} simulated seconds in {wall_time:.2f} seconds")
+    truncated = sum(result["truncated"] for result in results)
+    if truncated:
+        print(f"{truncated} datagrams were longer than the {RECEIVE_BUFFER_SIZE} byte receive buffer and were cut off, "
+              "so some switches are missing routes. Deployed switches would lose them too.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Flight recorder and sampling profiler for the controller and switches.
+
+The flight recorder keeps the most recent control events in a fixed-size ring buffer, only formatting
+them when dumped, so it can stay enabled all the time. The profiler samples the stacks of the threads
+running the given functions and tracks allocations with tracemalloc, and costs nothing while stopped.
+
+Send SIGUSR1 to a process to dump its flight recorder, and SIGUSR2 to start or stop a profiling session.
+"""
+
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque, Counter
+from datetime import datetime
+
+
+class FlightRecorder:
+
+    def __init__(self, size, clock=time.time):
+        # Appending to a deque is thread safe, and the oldest event falls off once it is full
+        self.events = deque(maxlen=size)
+        self.clock = clock
+
+    def record(self, event, *details):
+        """
+        Record an event along with any details (switch ids, message sizes, durations, ...).
+        """
+        self.events.append((self.clock(), event, details))
+
+    def dump(self, file_name):
+        """
+        Append the recorded events to the given file, oldest first.
+        """
+        log = [f"FLIGHT RECORDER DUMP {datetime.time(datetime.now())} ({len(self.events)} events)\n"]
+        for timestamp, event, details in list(self.events):
+            log.append(f"{datetime.time(datetime.fromtimestamp(timestamp))} {event} {' '.join(self.format_detail(detail) for detail in details)}\n")
+        with open(file_name, 'a+') as log_file:
+            log_file.write("\n\n")
+            log_file.writelines(log)
+
+    def format_detail(self, detail):
+        # Durations are recorded as raw seconds, show them down to the microsecond
+        if isinstance(detail, float):
+            return f"{detail:.6f}"
+        return str(detail)
+
+
+class SamplingProfiler:
+
+    def __init__(self, function_names, interval=0.005):
+        """
+        Profile the threads while they are inside one of the functions with the given names,
+        taking a sample every interval seconds.
+        """
+        self.function_names = set(function_names)
+        self.interval = interval
+        self.thread = None
+        self.samples = Counter()
+        self.num_samples = 0
+        self.start_time = None
+
+    def toggle(self, file_name):
+        """
+        Start a profiling session, or stop the running one and append its report to the given file.
+        """
+        if self.thread is None:
+            self.start()
+        else:
+            self.stop(file_name)
+
+    def start(self):
+        self.samples = Counter()
+        self.num_samples = 0
+        self.start_time = datetime.now()
+        tracemalloc.start()
+        self.thread = threading.Thread(target=self.thread_sample, daemon=True)
+        self.thread.start()
+
+    def stop(self, file_name):
+        thread = self.thread
+        self.thread = None
+        thread.join()
+        # Leave out the profiler's own samples and tracemalloc's bookkeeping
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__),
+                                                              tracemalloc.Filter(False, tracemalloc.__file__)])
+        tracemalloc.stop()
+        self.write_report(file_name, snapshot)
+
+    def thread_sample(self):
+        """
+        The method to be passed as the run method for the sampling thread. Runs until stop() is called.
+        """
+        me = threading.get_ident()
+        while self.thread is not None:
+            time.sleep(self.interval)
+            self.num_samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != me:
+                    stack = self.profiled_stack(frame)
+                    if stack is not None:
+                        self.samples[stack] += 1
+
+    def profiled_stack(self, frame):
+        """
+        The stack from the outermost profiled function down to the given frame, as a tuple of function:line,
+        or None if the frame is not inside a profiled function or is inside the profiler.
+        """
+        stack = []
+        found = None
+        while frame is not None:
+            # Leave out the profiler itself, e.g. while a signal handler is stopping it
+            if frame.f_code.co_filename == __file__:
+                return None
+            stack.append(f"{frame.f_code.co_name}:{frame.f_lineno}")
+            if frame.f_code.co_name in self.function_names:
+                found = len(stack)
+            frame = frame.f_back
+        if found is None:
+            return None
+        return tuple(reversed(stack[:found]))
+
+    def write_report(self, file_name, snapshot):
+        log = [f"PROFILE {datetime.time(self.start_time)} to {datetime.time(datetime.now())}, "
+               f"{self.num_samples} samples every {self.interval * 1000:g}ms\n"]
+        log.append("Stacks inside " + ", ".join(sorted(self.function_names)) + " (% of samples):\n")
+        for stack, count in self.samples.most_common(20):
+            log.append(f"{100 * count / max(self.num_samples, 1):6.1f}% {' > '.join(stack)}\n")
+        log.append("Largest allocations made during the session and still held when it stopped:\n")
+        for stat in snapshot.statistics("lineno")[:10]:
+            log.append(f"{stat}\n")
+        with open(file_name, 'a+') as log_file:
+            log_file.write("\n\n")
+            log_file.writelines(log)
+
+
+def install_signal_handlers(recorder, profiler, dump_file, profile_file):
+    """
+    Dump the flight recorder to dump_file on SIGUSR1, and toggle the profiler on SIGUSR2,
+    writing its report to profile_file. Must be called from the main thread.
+    """
+    # These signals do not exist on every platform (e.g. Windows)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: recorder.dump(dump_file))
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle(profile_file))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""Client and benchmark for the controller's route query service.
+
+Query a running controller started with -q <query port>:
+    python route_query.py <query port> <NEXT_HOP|DISTANCE|PATH> <Switch ID> <Dest ID> [<NEXT_HOP|DISTANCE|PATH> <Switch ID> <Dest ID> ...]
+
+Measure queries per second on a generated topology:
+    python route_query.py --benchmark [-n <switches>]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from socket import *
+
+import emulator
+from controller import Controller
+
+QUERY_TYPES = ("NEXT_HOP", "DISTANCE", "PATH")
+# Seconds to wait for the controller to answer
+QUERY_TIMEOUT = 2.0
+
+
+def query(query_port, queries, sock=None):
+    """
+    Send a list of (type, src, dst) queries to the controller in one datagram.
+    Returns the table version and the answer lines. Raises socket.timeout if no answer arrives within QUERY_TIMEOUT.
+    """
+    if sock is None:
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.settimeout(QUERY_TIMEOUT)
+    message = "".join(f"{kind} {src} {dst}\n" for kind, src, dst in queries)
+    sock.sendto(message.encode("utf-8"), ("localhost", query_port))
+    data, addr = sock.recvfrom(65535)
+    lines = data.decode("utf-8").split("\n")[:-1]
+    return lines[0], lines[1:]
+
+
+def random_queries(rng, kind, num_switches, count):
+    return [(kind, rng.randrange(num_switches), rng.randrange(num_switches)) for i in range(count)]
+
+
+def measure(name, function, count):
+    """
+    Run function, which answers count queries, and print how many queries per second that was.
+    """
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40}{count:>10}{count / elapsed:>16.0f}")
+
+
+def benchmark(num_switches, degree, count, bulk, seed):
+    emulator.silence_output()
+    handle, config_file = tempfile.mkstemp(suffix=".txt", text=True)
+    with os.fdopen(handle, "w") as file:
+        file.writelines(emulator.generate_config(num_switches, degree, seed))
+    # Port 0 lets the OS pick any free port, the benchmark never uses the controller's main socket
+    controller = Controller(0, config_file)
+    os.remove(config_file)
+    controller.switch_statuses = [True] * num_switches
+    controller.compute_routes()
+    rng = random.Random(seed)
+
+    def answer_each(queries):
+        for kind, src, dst in queries:
+            controller.answer_queries(f"{kind} {src} {dst}\n")
+
+    def answer_bulk(queries):
+        for i in range(0, len(queries), bulk):
+            controller.answer_queries("".join(f"{kind} {src} {dst}\n" for kind, src, dst in queries[i:i + bulk]))
+
+    print(f"{num_switches} switches, {len(controller.lengths) // 2} links\n")
+    print(f"{'in process':<40}{'queries':>10}{'queries/s':>16}")
+    for kind in QUERY_TYPES:
+        queries = random_queries(rng, kind, num_switches, count)
+        measure(f"{kind}", lambda: answer_each(queries), count)
+    # Ask for the same paths again, this time they are memoized
+    measure("PATH again (memoized)", lambda: answer_each(queries), count)
+    measure(f"PATH in bulk of {bulk} (memoized)", lambda: answer_bulk(queries), count)
+
+    # A link on a shortest path failing changes the table version, which drops the memoized paths
+    link = (0, controller.routes_by_switch[0][num_switches - 1][2])
+    controller.lengths[link] = controller.lengths[link[::-1]] = 9999
+    controller.compute_routes()
+    measure("PATH after a table change", lambda: answer_each(queries), count)
+
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.bind(("localhost", 0))
+    query_port = sock.getsockname()[1]
+    sock.close()
+    controller.start_query_thread(query_port)
+    client = socket(AF_INET, SOCK_DGRAM)
+    client.settimeout(QUERY_TIMEOUT)
+    print(f"\n{'over loopback UDP':<40}{'queries':>10}{'queries/s':>16}")
+    for kind in QUERY_TYPES:
+        queries = random_queries(rng, kind, num_switches, count)
+        measure(f"{kind}", lambda: [query(query_port, [q], client) for q in queries], count)
+    queries = random_queries(rng, "DISTANCE", num_switches, count)
+    measure(f"DISTANCE in bulk of {bulk}",
+            lambda: [query(query_port, queries[i:i + bulk], client) for i in range(0, count, bulk)], count)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] != "--benchmark":
+        if len(sys.argv) < 5 or (len(sys.argv) - 2) % 3 != 0:
+            print(__doc__)
+            sys.exit(1)
+        args = sys.argv[2:]
+        queries = [(args[i], args[i + 1], args[i + 2]) for i in range(0, len(args), 3)]
+        try:
+            version, answers = query(int(sys.argv[1]), queries)
+        except timeout:
+            print(f"No answer from port {sys.argv[1]} within {QUERY_TIMEOUT:g} seconds. "
+                  "Is the controller running with -q on that port?")
+            sys.exit(1)
+        print(f"Routing table version {version}")
+        print("\n".join(answers))
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the route query service.")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("-n", "--switches", type=int, default=1000, help="number of switches in the generated topology")
+    parser.add_argument("--degree", type=int, default=3, help="average degree of the generated topology")
+    parser.add_argument("--count", type=int, default=20000, help="number of queries for each measurement")
+    parser.add_argument("--bulk", type=int, default=100, help="number of queries per datagram for bulk queries")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    benchmark(args.switches, args.degree, args.count, args.bulk, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,16 @@ from socket import *
 import time
 import threading
 
+from flight_recorder import FlightRecorder, SamplingProfiler, install_signal_handlers
+
 # Please do not modify the name of the log file, otherwise you will lose points because the grader won't be able to find your log file
 LOG_FILE = "switch#.log" # The log file for switches are switch#.log, where # is the id of that switch (i.e. switch0.log, switch1.log). The code for replacing # with a real number has been given to you in the main function.
 K = 2
 TIMEOUT = 3 * K
+# The number of recent control events kept by the flight recorder. Dumped to switch#.flight.log on SIGUSR1.
+FLIGHT_RECORDER_SIZE = 1000
+# Weight of a new round trip time sample in the smoothed round trip time of a neighbor (same as TCP's SRTT)
+RTT_ALPHA = 0.125
 
 # Those are logging functions to help you follow the correct logging standard
 
@@ -94,22 +100,33 @@ def write_to_log(log):
 
 class Switch:
 
-    def __init__(self, switch_id, controller_port, controller_hostname="localhost", failed_link_neighbor_id=-1):
+    def __init__(self, switch_id, controller_port, controller_hostname="localhost", failed_link_neighbor_id=-1, sock=None):
         """
-        Switch constructor.
+        Switch constructor. A socket-like object may be passed in as sock (e.g. by the emulator).
         """
         self.switch_id = switch_id
         self.failed_link_neighbor_id = failed_link_neighbor_id
         self.controller_hostname = controller_hostname
         self.controller_port = controller_port
         self.controller_address = (controller_hostname, controller_port)
-        self.sock = socket(AF_INET, SOCK_DGRAM)
+        if sock is None:
+            sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock = sock
+        # The clock used for TIMEOUT bookkeeping. The emulator swaps this for a virtual clock.
+        self.clock = time.time
+        # Recent control events, kept in case convergence needs to be investigated
+        self.recorder = FlightRecorder(FLIGHT_RECORDER_SIZE)
         # To be updated when registering
         # This is a map that takes a neighbor's id as the key and gives an index into their other data as a value
         self.neighbor_ids_to_index = {}
         self.neighbor_addrs = None
         self.neighbor_statuses = None
         self.last_update_times = None
+        # Smoothed round trip time to each neighbor in seconds, None until measured
+        self.neighbor_rtts = None
+        # The last timestamp received from each neighbor and when it arrived, echoed back in the next keep alive
+        self.neighbor_timestamps = None
+        self.timestamp_receive_times = None
         # sock.bind(("localhost", int(sys.argv[1])))
 
     def bootstrap(self):
@@ -118,36 +135,52 @@ class Switch:
         This creates a thread for each neighbor, keeping track of whether it has timed out or not.
         """
         self.send_register_request()
+        self.start_threads()
+
+    def start_threads(self):
+        """
+        Start the keep alive thread and a TIMEOUT thread for each neighbor. Called once registered.
+        """
         # Start a thread to manage sending periodic keep alive and topology updates
         new_thread = threading.Thread(target=self.thread_keep_alive, daemon=True)
         new_thread.start()
-        # Initially assume all other neighbors are alive
-        self.neighbor_statuses = [True] * len(self.neighbor_addrs)
-        self.last_update_times = [-1] * len(self.neighbor_addrs)
         for neighbor_id in self.neighbor_ids_to_index.keys():
-            self.last_update_times[self.neighbor_ids_to_index[neighbor_id]] = time.time()
-            new_thread = threading.Thread(target=self.thread_proc, args=(neighbor_id,), daemon=True)
-            # Start the new thread
-            new_thread.start()
+            self.start_timeout_thread(neighbor_id)
             # Wait a moment to prevent all switches from timing out at the same time
             # time.sleep(0.3)
 
+    def start_timeout_thread(self, neighbor_id):
+        """
+        Start a thread that manages whether or not the neighbor with the given id has timed out yet.
+        """
+        new_thread = threading.Thread(target=self.thread_proc, args=(neighbor_id,), daemon=True)
+        new_thread.start()
 
     def thread_proc(self, neighbor_id):
         """
         Mange whether or not the neighbor with the given id has timed out yet.
         """
         neighbor_index = self.neighbor_ids_to_index[neighbor_id]
-        time_elapsed = time.time() - self.last_update_times[neighbor_index]
+        time_elapsed = self.clock() - self.last_update_times[neighbor_index]
         while time_elapsed < TIMEOUT:
             # Wait until the TIMEOUT might have happened
             time.sleep(TIMEOUT - time_elapsed)
-            time_elapsed = time.time() - self.last_update_times[neighbor_index]
+            time_elapsed = self.clock() - self.last_update_times[neighbor_index]
         # If we have broken out of the while loop above, the switch has TIMED OUT -> link is dead
-        # Recompute topology, send it out to all live switches, kill this thread.
+        self.handle_neighbor_timeout(neighbor_id)
+
+    def handle_neighbor_timeout(self, neighbor_id):
+        """
+        The neighbor with the given id has TIMED OUT. Notify the controller, then kill this thread.
+        """
+        neighbor_index = self.neighbor_ids_to_index[neighbor_id]
         print(f"NEIGHBOR {neighbor_id} HAS TIMED OUT")
+        self.recorder.record("timeout", neighbor_id)
         neighbor_dead(neighbor_id)
         self.neighbor_statuses[neighbor_index] = False
+        # Start measuring from scratch once it comes back
+        self.neighbor_rtts[neighbor_index] = None
+        self.neighbor_timestamps[neighbor_index] = None
         # Notify the controller about a topology update
         self.send_topology_update()
 
@@ -164,22 +197,32 @@ class Switch:
             # Above is not good. The link failure mode is now handled by send_keep_alive
             self.send_keep_alive()
 
-    def send_register_request(self):
+    def send_register_request(self, wait=True):
         """
         Send a register request to the controller. Waits for a register response from the controller and returns once received.
+        If wait is False, return right after sending and leave the response to handle_register_response.
         """
         # Construct the message
         message = f"{self.switch_id} Register_Request"
         b_message = message.encode("utf-8")
         # Send it
+        self.recorder.record("send", "register_request", len(b_message))
         self.sock.sendto(b_message, self.controller_address)
         # Log that a register request was sent
         register_request_sent()
+        if not wait:
+            return
         # Wait for the register response
         data, addr = self.sock.recvfrom(1024)
+        self.handle_register_response(data.decode("utf-8"))
+
+    def handle_register_response(self, message):
+        """
+        Set up the neighbor information from the register response sent by the controller.
+        """
+        self.recorder.record("recv", "register_response", len(message))
         # Log that it was received
         register_response_received()
-        message = data.decode("utf-8")
         lines = message.split("\n")
         num_neighbors = int(lines[0])
         # The addresses (hostname, port) of the neighbors
@@ -192,35 +235,68 @@ class Switch:
                 continue
             self.neighbor_ids_to_index[int(parts[0])] = neighbor_index
             self.neighbor_addrs[neighbor_index] = (parts[1], int(parts[2]))
+        # Initially assume all other neighbors are alive
+        self.neighbor_statuses = [True] * num_neighbors
+        self.last_update_times = [self.clock()] * num_neighbors
+        self.neighbor_rtts = [None] * num_neighbors
+        self.neighbor_timestamps = [None] * num_neighbors
+        self.timestamp_receive_times = [None] * num_neighbors
         # print(f"I am switch {self.switch_id}")
         # print(f"My neighbors:\n{self.neighbor_ids}")
 
     def send_keep_alive(self):
         """
         Send the keep-alive message to all neighbor switches.
+        Each message carries the time it was sent, along with the last timestamp received from that neighbor
+        and how long ago it was received, so the neighbor can measure the round trip time without synchronized clocks:
+        <Switch ID> KEEP_ALIVE <Timestamp> [<Echoed timestamp> <Time held>]
         """
-        message = f"{self.switch_id} KEEP_ALIVE"
         print(f"Switch {self.switch_id}: Sending KEEP ALIVE message to switch ids {list(self.neighbor_ids_to_index.keys())}")
-        b_message = message.encode("utf-8")
+        now = self.clock()
         for neighbor_id in self.neighbor_ids_to_index.keys():
             neighbor_index = self.neighbor_ids_to_index[neighbor_id]
             neighbor_addr = self.neighbor_addrs[neighbor_index]
+            message = f"{self.switch_id} KEEP_ALIVE {now}"
+            # Read these once, the timeout thread may clear them at any moment
+            timestamp = self.neighbor_timestamps[neighbor_index]
+            receive_time = self.timestamp_receive_times[neighbor_index]
+            if timestamp is not None and receive_time is not None:
+                message += f" {timestamp} {now - receive_time}"
+            b_message = message.encode("utf-8")
             # If this is not a link we are simulating as dead, send a keep alive message.
             if not self.failed_link_neighbor_id == neighbor_id:
+                self.recorder.record("send", "keep_alive", neighbor_id, len(b_message))
                 self.sock.sendto(b_message, neighbor_addr)
             else:
                 print(f"Switch {self.switch_id}: DID NOT SEND KEEP ALIVE message to switch id {self.failed_link_neighbor_id}")
     
+    def update_rtt(self, neighbor_index, sample):
+        """
+        Fold a round trip time sample into the smoothed round trip time of the neighbor.
+        """
+        sample = max(sample, 0.0)
+        rtt = self.neighbor_rtts[neighbor_index]
+        if rtt is None:
+            self.neighbor_rtts[neighbor_index] = sample
+        else:
+            self.neighbor_rtts[neighbor_index] = (1 - RTT_ALPHA) * rtt + RTT_ALPHA * sample
+
     def send_topology_update(self):
         """
-        Send a topology update to the controller, detailing which neighbors are still alive and which are dead.
+        Send a topology update to the controller, detailing which neighbors are still alive and which are dead,
+        along with the smoothed round trip time to each of them in seconds (-1 if not measured yet).
         """
         message = f"{self.switch_id}\n"
-        print(f"Switch {self.switch_id}: Sending topology update.\nNeighbor IDs to Index: {self.neighbor_ids_to_index}\nNeighbor Statuses: {self.neighbor_statuses}\n")
+        print(f"Switch {self.switch_id}: Sending topology update.\nNeighbor IDs to Index: {self.neighbor_ids_to_index}\nNeighbor Statuses: {self.neighbor_statuses}\nNeighbor RTTs: {self.neighbor_rtts}\n")
         for neighbor_id in self.neighbor_ids_to_index.keys():
-            message += f"{neighbor_id} {self.neighbor_statuses[self.neighbor_ids_to_index[neighbor_id]]}\n"
+            neighbor_index = self.neighbor_ids_to_index[neighbor_id]
+            rtt = self.neighbor_rtts[neighbor_index]
+            # Microsecond precision keeps the message short, the controller reads at most 1024 bytes
+            rtt_text = -1 if rtt is None else f"{rtt:.6f}"
+            message += f"{neighbor_id} {self.neighbor_statuses[neighbor_index]} {rtt_text}\n"
 
         b_message = message.encode("utf-8")
+        self.recorder.record("send", "topology_update", len(b_message))
         self.sock.sendto(b_message, self.controller_address)
 
     def await_messages(self):
@@ -231,11 +307,18 @@ class Switch:
         create a new thread that manages checking if TIMEOUT has happened.
         """
         data, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
-        data = data.decode("utf-8")
+        self.handle_message(data.decode("utf-8"), addr)
+
+    def handle_message(self, data, addr):
+        """
+        Handle a single decoded message received from a neighbor or the controller.
+        """
         # If it is a KEEP ALIVE message, note that the connection is still alive if it was alive before
         # If it was dead before, notify the controller of a change in topology
         if "KEEP_ALIVE" in data:
-            neighbor_id = int(data[0])
+            parts = data.split(" ")
+            neighbor_id = int(parts[0])
+            self.recorder.record("recv", "keep_alive", neighbor_id, len(data))
             print(f"Switch {self.switch_id}: Received KEEP ALIVE message from switch id {neighbor_id}")
             neighbor_index = self.neighbor_ids_to_index[neighbor_id]
             self.neighbor_addrs[neighbor_index] = addr
@@ -247,15 +330,29 @@ class Switch:
             # Consider it alive now
             self.neighbor_statuses[neighbor_index] = True
             # Reset the timeout
-            self.last_update_times[neighbor_index] = time.time()
+            self.last_update_times[neighbor_index] = self.clock()
+            # Remember the timestamp to echo back, and measure the round trip time if ours was echoed
+            # The timing fields only feed the round trip time, so skip them if they can't be parsed
+            try:
+                if len(parts) > 2:
+                    self.neighbor_timestamps[neighbor_index] = float(parts[2])
+                    self.timestamp_receive_times[neighbor_index] = self.clock()
+                if len(parts) > 4:
+                    self.update_rtt(neighbor_index, self.clock() - float(parts[3]) - float(parts[4]))
+            except ValueError:
+                print(f"Switch {self.switch_id}: Ignoring the timing fields of KEEP ALIVE message {data}")
             # If wasn't previously alive, immediately notify the controller of the change
             if not was_alive:
                 self.send_topology_update()
                 neighbor_alive(neighbor_id)
+                # The old TIMEOUT thread ended when the neighbor died, so start watching it again
+                self.start_timeout_thread(neighbor_id)
         # Otherwise it was a routing update from the controller. Handle it.
         else:
-            switch_id = data[0]
-            lines = data.split("\n")[1:-1]
+            self.recorder.record("recv", "route_update", len(data))
+            lines = data.split("\n")
+            switch_id = lines[0]
+            lines = lines[1:-1]
             table = []
             for line in lines:
                 parts = line.split(" ")
@@ -274,7 +371,8 @@ class Switch:
 
             # Log the routing table that was received
             routing_table_update(table)
-            print(f"Switch {self.switch_id}: Received routing info from controller: {table}")
+            # Pass the table separately so it is only formatted when actually printed
+            print(f"Switch {self.switch_id}: Received routing info from controller:", table)
 
 
 def main():
@@ -297,6 +395,9 @@ def main():
         switch = Switch(my_id, controller_port, failed_link_neighbor_id=neighbor_id)
     else:
         switch = Switch(my_id, controller_port)
+    # SIGUSR1 dumps the flight recorder, SIGUSR2 starts or stops profiling
+    profiler = SamplingProfiler(["await_messages"])
+    install_signal_handlers(switch.recorder, profiler, f"switch{my_id}.flight.log", f"switch{my_id}.profile.log")
     switch.bootstrap()
     # time.sleep(5)
     # switch.send_topology_update()